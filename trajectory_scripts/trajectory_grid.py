@@ -7,7 +7,7 @@ and the original CSV to build a geographic grid.
 Each cell in the grid is coloured by how many trajectory points pass through it.
 White = 0 trips  →  Deep colour = maximum frequency.
 
-Outputs: trajectory_grid.html  (self-contained, embeds all charts as base64 PNG)
+Outputs: trajectory_grid.html  (self-contained, embeds all charts as base64 WebP)
 
 Run:
     python trajectory_grid.py
@@ -16,12 +16,18 @@ Change GRID_SIZE below to switch between 16 and 32.
 
 Requirements:
     pip install pandas matplotlib seaborn
+    pip install orjson           # optional — faster route-cache loading
+    pip install fast-histogram   # optional — faster uniform 2-D binning
+    pip install numba            # optional — multi-core binning for big caches
 """
 
 import os
 import json
 import base64
 import io
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 import numpy as np
@@ -31,13 +37,59 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import seaborn as sns
 
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:                             # optional — stdlib json is used
+    HAVE_ORJSON = False
+
+try:
+    from fast_histogram import histogram2d
+    HAVE_FAST_HISTOGRAM = True
+except ImportError:                             # optional — NumPy path is used
+    HAVE_FAST_HISTOGRAM = False
+
+try:
+    import numba
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:                             # optional — NumPy path is used
+    HAVE_NUMBA = False
+
 # ─── Configuration ─────────────────────────────────────────────────────────────
 CSV_FILE    = "synthetic_data.csv"
 CACHE_FILE  = "route_cache.json"
+CACHE_LOG   = "route_cache.log"     # uncompacted routes (see visualize_trajectories.py)
 OUTPUT_FILE = "trajectory_grid.html"
 
 GRID_SIZE   = 16          # change to 16 for a coarser grid
 
+# Without fast-histogram, point clouds at least this large are binned with the
+# parallel Numba kernel (when numba is installed). Loading the kernel costs a
+# fixed ~0.12 s per run from Numba's disk cache and ~3 s when it has to
+# compile. On the sample cache (363k points) that loses to NumPy (4 ms) and
+# fast-histogram (2 ms); at 23M points, load included, it takes 0.20 s vs
+# 0.46 s for NumPy and 0.23 s for fast-histogram.
+NUMBA_MIN_POINTS = 20_000_000
+
+# Embedded chart images — WebP at screen resolution keeps the HTML small
+# (lossy q82 is visually indistinguishable from PNG for these heatmaps).
+IMAGE_FORMAT     = "webp"
+IMAGE_DPI        = 96
+IMAGE_PIL_KWARGS = {"quality": 82, "method": 4}
+
+# Image bytes are base64-encoded into the HTML in chunks of this size
+# (a multiple of 3, so chunks concatenate without padding in between).
+B64_CHUNK = 57 * 1024
+
+# Per-vehicle heatmaps are rendered in up to this many worker processes
+# (savefig is CPU-bound, so threads would just contend for the GIL), capped
+# at the CPU count; on a single core they are rendered in-process, since each
+# worker's imports cost more than a render. Workers are spawned rather than
+# forked: forking after the Numba kernel has started its thread pool can
+# deadlock.
+RENDER_WORKERS = 4
+
 # Colour per vehicle (same palette as the map)
 VEHICLE_COLORS = {
     "EV Car":    "#1E90FF",   # blue
@@ -59,10 +111,26 @@ PROFILE_MAP = {
 # ─────────────────────────────────────────────────────────────────────────────
 
 def load_cache() -> dict:
+    cache = {}
     if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as f:
-            return json.load(f)
-    return {}
+        if HAVE_ORJSON:
+            with open(CACHE_FILE, "rb") as f:
+                cache = orjson.loads(f.read())
+        else:
+            with open(CACHE_FILE, "r") as f:
+                cache = json.load(f)
+
+    # Replay routes appended since the last snapshot
+    if os.path.exists(CACHE_LOG):
+        loads = orjson.loads if HAVE_ORJSON else json.loads
+        with open(CACHE_LOG, "rb") as f:
+            for line in f:
+                try:
+                    key, route = loads(line)
+                except ValueError:
+                    continue   # torn line from an interrupted run
+                cache[key] = route
+    return cache
 
 
 def make_colormap(hex_color: str):
@@ -72,78 +140,143 @@ def make_colormap(hex_color: str):
     )
 
 
-def fig_to_base64(fig) -> str:
-    """Convert a matplotlib figure to a base64-encoded PNG string."""
+def fig_to_image(fig) -> io.BytesIO:
+    """Render a matplotlib figure to an in-memory IMAGE_FORMAT buffer."""
     buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=130, bbox_inches="tight",
-                facecolor=fig.get_facecolor())
-    buf.seek(0)
-    encoded = base64.b64encode(buf.read()).decode("utf-8")
+    fig.savefig(buf, format=IMAGE_FORMAT, dpi=IMAGE_DPI, bbox_inches="tight",
+                facecolor=fig.get_facecolor(), pil_kwargs=IMAGE_PIL_KWARGS)
     plt.close(fig)
-    return encoded
+    return buf
+
+
+def write_base64(f, buf: io.BytesIO):
+    """Stream the contents of `buf` into file `f` as base64, chunk by chunk."""
+    with buf.getbuffer() as view:
+        for i in range(0, len(view), B64_CHUNK):
+            f.write(base64.b64encode(view[i:i + B64_CHUNK]).decode("ascii"))
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Grid building
 # ─────────────────────────────────────────────────────────────────────────────
 
-def build_grid(points: list[tuple], lat_min, lat_max, lon_min, lon_max,
+if HAVE_NUMBA:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def bin_points(pts, lat_min, lat_max, lon_min, lon_max, n, n_chunks):
+        """
+        Compiled, multi-core equivalent of the NumPy binning in build_grid,
+        used only for huge clouds when fast-histogram is missing (see
+        NUMBA_MIN_POINTS): one pass over the (N, 2) buffer, computing
+        idx = row*n + col and bumping an int64 counter, with no per-point
+        temporary arrays. Points are split into n_chunks contiguous slices,
+        each counted into its own slab; slabs are summed at the end.
+        """
+        local = np.zeros((n_chunks, n * n), dtype=np.int64)
+        lat_scale = n / (lat_max - lat_min)
+        lon_scale = n / (lon_max - lon_min)
+        size = pts.shape[0]
+        step = (size + n_chunks - 1) // n_chunks
+
+        for t in prange(n_chunks):
+            for i in range(t * step, min((t + 1) * step, size)):
+                col = int((pts[i, 1] - lon_min) * lon_scale)
+                row = int((lat_max - pts[i, 0]) * lat_scale)   # flip: north = row 0
+                col = min(max(col, 0), n - 1)
+                row = min(max(row, 0), n - 1)
+                local[t, row * n + col] += 1
+
+        return local.sum(axis=0).reshape(n, n).astype(np.float64)
+
+
+def build_grid(points: np.ndarray, lat_min, lat_max, lon_min, lon_max,
                n: int) -> np.ndarray:
     """
-    Given a list of (lat, lon) points and a bounding box, return an n×n
-    numpy array where each cell contains the number of points that fall
-    inside it.
+    Given an (N, 2) array of (lat, lon) points and a bounding box, return
+    an n×n numpy array where each cell contains the number of points that
+    fall inside it.
 
     Row 0 = northernmost band (top of map), col 0 = westernmost band (left).
     """
-    grid = np.zeros((n, n), dtype=float)
-
     lat_range = lat_max - lat_min
     lon_range = lon_max - lon_min
 
-    if lat_range == 0 or lon_range == 0:
-        return grid
+    pts = np.asarray(points).reshape(-1, 2)          # float32 or float64
+    if lat_range == 0 or lon_range == 0 or len(pts) == 0:
+        return np.zeros((n, n), dtype=float)
 
-    for lat, lon in points:
-        col = int((lon - lon_min) / lon_range * n)
-        row = int((lat_max - lat) / lat_range * n)   # flip: north = row 0
-        # clamp to valid indices
-        col = min(max(col, 0), n - 1)
-        row = min(max(row, 0), n - 1)
-        grid[row, col] += 1
+    if HAVE_FAST_HISTOGRAM:
+        # fast-histogram drops points outside [min, max); clip them into the
+        # box first so edge points land in the edge cells as before.
+        lats = np.clip(pts[:, 0], lat_min, np.nextafter(lat_max, lat_min))
+        lons = np.clip(pts[:, 1], lon_min, np.nextafter(lon_max, lon_min))
+        grid = histogram2d(lats, lons, bins=[n, n],
+                           range=[[lat_min, lat_max], [lon_min, lon_max]])
+        return np.flipud(grid)                  # flip: north = row 0
 
-    return grid
+    if HAVE_NUMBA and len(pts) >= NUMBA_MIN_POINTS:
+        return bin_points(pts, lat_min, lat_max, lon_min, lon_max,
+                          n, numba.get_num_threads())
 
+    col = ((pts[:, 1] - lon_min) * (n / lon_range)).astype(np.intp)
+    row = ((lat_max - pts[:, 0]) * (n / lat_range)).astype(np.intp)  # flip: north = row 0
+    # clamp to valid indices
+    np.clip(col, 0, n - 1, out=col)
+    np.clip(row, 0, n - 1, out=row)
+
+    counts = np.bincount(row * n + col, minlength=n * n)
+    return counts.reshape(n, n).astype(float)
 
-def collect_points_from_cache(cache: dict, vtypes: list[str]) -> list[tuple]:
-    """
-    Pull all [lat, lon] coordinate points from cached routes that belong
-    to the requested vehicle types.
 
-    Cache keys contain the ORS profile as the last segment separated by '|'.
+def _pack_cache_points(cache: dict) -> tuple[np.ndarray, dict]:
     """
-    profiles = {PROFILE_MAP[v] for v in vtypes if v in PROFILE_MAP}
-    points = []
+    Pack every cached route into one contiguous (N, 2) float64 [lat, lon]
+    buffer, grouped by ORS profile (cache keys end in '|<profile>').
+
+    Returns (coords, profile_spans): profile p → coords[start : end] for
+    (start, end) = profile_spans[p].
 
+    Kept at float64: float32 shifts points lying near a cell edge into the
+    neighbouring cell.
+    """
+    by_profile = defaultdict(list)
     for key, route in cache.items():
-        if not route:
-            continue
-        key_profile = key.split("|")[-1]
-        if key_profile in profiles:
-            for pt in route:
-                points.append((pt[0], pt[1]))   # lat, lon
+        if route:
+            by_profile[key.rpartition("|")[2]].append(route)
+
+    total  = sum(len(route) for group in by_profile.values() for route in group)
+    coords = np.empty((total, 2), dtype=np.float64)
 
-    return points
+    profile_spans = {}
+    end = 0
+    for profile, group in by_profile.items():
+        start = end
+        for route in group:
+            coords[end:end + len(route)] = route
+            end += len(route)
+        profile_spans[profile] = (start, end)
 
+    return coords, profile_spans
+
+
+def collect_points_by_profile(cache: dict) -> dict[str, np.ndarray]:
+    """
+    Walk the cache once and return {ORS profile → (N, 2) array of [lat, lon]}.
+
+    The arrays are zero-copy views into a single float64 buffer.
+    Vehicles sharing a profile (Rickshaw / Remork) share the same array.
+    """
+    coords, profile_spans = _pack_cache_points(cache)
+    return {
+        profile: coords[start:end]
+        for profile, (start, end) in profile_spans.items()
+    }
 
-def collect_od_points(df: pd.DataFrame, vtypes: list[str]) -> list[tuple]:
+
+def collect_od_points(df: pd.DataFrame, vtypes: list[str]) -> np.ndarray:
     """Fallback: collect origin + destination points from the CSV."""
-    sub = df[df["vehicle_type"].isin(vtypes)]
-    points = []
-    for _, row in sub.iterrows():
-        points.append((row["dept_lat"], row["dept_lon"]))
-        points.append((row["arr_lat"],  row["arr_lon"]))
-    return points
+    sub = df.loc[df["vehicle_type"].isin(vtypes),
+                 ["dept_lat", "dept_lon", "arr_lat", "arr_lon"]].to_numpy(dtype=float)
+    return np.vstack([sub[:, 0:2], sub[:, 2:4]])
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -151,9 +284,9 @@ def collect_od_points(df: pd.DataFrame, vtypes: list[str]) -> list[tuple]:
 # ─────────────────────────────────────────────────────────────────────────────
 
 def plot_heatmap(grid: np.ndarray, title: str, hex_color: str,
-                 n: int, show_values: bool = False) -> str:
+                 n: int, show_values: bool = False) -> io.BytesIO:
     """
-    Draw a single heatmap and return it as a base64 PNG string.
+    Draw a single heatmap and return it as an in-memory image buffer.
     show_values=True prints the count in each cell (only practical for 16×16).
     """
     cmap = make_colormap(hex_color)
@@ -181,12 +314,25 @@ def plot_heatmap(grid: np.ndarray, title: str, hex_color: str,
     cbar = ax.collections[0].colorbar
     cbar.set_label("Trip point density", fontsize=8)
 
-    return fig_to_base64(fig)
+    return fig_to_image(fig)
+
+
+def _render_one(vtype: str, hex_color: str, grid: np.ndarray,
+                n: int) -> tuple:
+    """Worker-process entry point: render one vehicle's heatmap."""
+    img = plot_heatmap(
+        grid,
+        title=f"{vtype}  —  {n}×{n}",
+        hex_color=hex_color,
+        n=n,
+        show_values=True,
+    )
+    return vtype, hex_color, img
 
 
-def plot_combined_heatmap(grids: dict, all_points: list[tuple],
+def plot_combined_heatmap(grids: dict, all_points: np.ndarray,
                           lat_min, lat_max, lon_min, lon_max,
-                          n: int) -> str:
+                          n: int) -> io.BytesIO:
     """
     Draw the combined (all vehicles) heatmap using a red-purple gradient.
     """
@@ -218,36 +364,31 @@ def plot_combined_heatmap(grids: dict, all_points: list[tuple],
     cbar = ax.collections[0].colorbar
     cbar.set_label("Total trip point density", fontsize=9)
 
-    return fig_to_base64(fig)
+    return fig_to_image(fig)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # HTML generation
 # ─────────────────────────────────────────────────────────────────────────────
 
-def build_html(combined_b64: str, per_vehicle: list[tuple]) -> str:
+def write_html(f, combined_img: io.BytesIO, per_vehicle: list[tuple]):
     """
-    Assemble a self-contained HTML page embedding all charts.
-    per_vehicle: list of (vehicle_name, hex_color, base64_png)
+    Write a self-contained HTML page embedding all charts to file `f`.
+    per_vehicle: list of (vehicle_name, hex_color, image_buffer)
+
+    Images are base64-encoded straight into the file, so the full page is
+    never held in memory as one string.
     """
 
-    def img_tag(b64: str, alt: str) -> str:
-        return (
-            f'<img src="data:image/png;base64,{b64}" '
-            f'alt="{alt}" style="max-width:100%;border-radius:6px;'
+    def write_img(buf: io.BytesIO, alt: str):
+        f.write(f'<img src="data:image/{IMAGE_FORMAT};base64,')
+        write_base64(f, buf)
+        f.write(
+            f'" alt="{alt}" style="max-width:100%;border-radius:6px;'
             f'box-shadow:0 2px 8px rgba(0,0,0,0.12);">'
         )
 
-    per_vehicle_html = ""
-    for vname, color, b64 in per_vehicle:
-        per_vehicle_html += f"""
-        <div class="card">
-            <h3 style="color:{color};">{vname}</h3>
-            {img_tag(b64, vname)}
-        </div>
-        """
-
-    return f"""<!DOCTYPE html>
+    f.write(f"""<!DOCTYPE html>
 <html lang="en">
 <head>
   <meta charset="UTF-8">
@@ -323,12 +464,26 @@ def build_html(combined_b64: str, per_vehicle: list[tuple]) -> str:
 
   <p class="section-title">All Vehicles Combined</p>
   <div class="combined-wrap">
-    {img_tag(combined_b64, "Combined heatmap")}
+    """)
+    write_img(combined_img, "Combined heatmap")
+    f.write("""
   </div>
 
   <p class="section-title">Per Vehicle Type</p>
   <div class="grid">
-    {per_vehicle_html}
+    """)
+
+    for vname, color, img in per_vehicle:
+        f.write(f"""
+        <div class="card">
+            <h3 style="color:{color};">{vname}</h3>
+            """)
+        write_img(img, vname)
+        f.write("""
+        </div>
+        """)
+
+    f.write(f"""
   </div>
 
   <footer>
@@ -337,7 +492,7 @@ def build_html(combined_b64: str, per_vehicle: list[tuple]) -> str:
     Source: {CSV_FILE}
   </footer>
 </body>
-</html>"""
+</html>""")
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -355,10 +510,10 @@ def main():
     print(f"  Cache entries: {len(cache)}")
 
     # ── Compute geographic bounding box ───────────────────────────────────────
-    lat_min = min(df["dept_lat"].min(), df["arr_lat"].min())
-    lat_max = max(df["dept_lat"].max(), df["arr_lat"].max())
-    lon_min = min(df["dept_lon"].min(), df["arr_lon"].min())
-    lon_max = max(df["dept_lon"].max(), df["arr_lon"].max())
+    lats = df[["dept_lat", "arr_lat"]].to_numpy(dtype=float)
+    lons = df[["dept_lon", "arr_lon"]].to_numpy(dtype=float)
+    lat_min, lat_max = np.nanmin(lats), np.nanmax(lats)
+    lon_min, lon_max = np.nanmin(lons), np.nanmax(lons)
 
     # Add small padding so edge points don't get clipped
     pad_lat = (lat_max - lat_min) * 0.02
@@ -371,40 +526,56 @@ def main():
 
     # ── Collect points per vehicle ────────────────────────────────────────────
     all_points = []
-    per_vehicle_charts = []
+    grids = {}
+    by_profile = collect_points_by_profile(cache)   # single pass over cache
+    no_points  = np.empty((0, 2), dtype=np.float64)
 
-    for vtype, hex_color in VEHICLE_COLORS.items():
+    for vtype in VEHICLE_COLORS:
         # Prefer full route points from cache; fall back to O/D points
-        pts = collect_points_from_cache(cache, [vtype])
+        pts = by_profile.get(PROFILE_MAP[vtype], no_points)
         source = "route cache"
 
-        if not pts:
+        if not len(pts):
             pts = collect_od_points(df, [vtype])
             source = "O/D points (no cache)"
 
         print(f"  {vtype:10s}: {len(pts):6d} points  ({source})")
-        all_points.extend(pts)
-
-        grid = build_grid(pts, lat_min, lat_max, lon_min, lon_max, n)
-        b64  = plot_heatmap(
-            grid,
-            title=f"{vtype}  —  {n}×{n}",
-            hex_color=hex_color,
-            n=n,
-            show_values=True,
-        )
-        per_vehicle_charts.append((vtype, hex_color, b64))
+        all_points.append(pts)
+        grids[vtype] = build_grid(pts, lat_min, lat_max, lon_min, lon_max, n)
 
-    # ── Combined chart ────────────────────────────────────────────────────────
+    all_points = np.concatenate(all_points)
     print(f"\n  Total points (all vehicles): {len(all_points)}")
-    combined_b64 = plot_combined_heatmap(
-        {}, all_points, lat_min, lat_max, lon_min, lon_max, n
+
+    # ── Render charts ─────────────────────────────────────────────────────────
+    render_args = (
+        VEHICLE_COLORS.keys(),
+        VEHICLE_COLORS.values(),
+        grids.values(),
+        [n] * len(grids),
     )
+    workers = min(RENDER_WORKERS, os.cpu_count() or 1)
+
+    if workers == 1:
+        per_vehicle_charts = list(map(_render_one, *render_args))
+        combined_img = plot_combined_heatmap(
+            grids, all_points, lat_min, lat_max, lon_min, lon_max, n
+        )
+    else:
+        # Per-vehicle heatmaps go to worker processes while the combined
+        # chart is drawn here in the main process.
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            results = executor.map(_render_one, *render_args)
+            combined_img = plot_combined_heatmap(
+                grids, all_points, lat_min, lat_max, lon_min, lon_max, n
+            )
+            per_vehicle_charts = list(results)
 
     # ── Write HTML ────────────────────────────────────────────────────────────
-    html = build_html(combined_b64, per_vehicle_charts)
     with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        f.write(html)
+        write_html(f, combined_img, per_vehicle_charts)
 
     print(f"\n✅ Saved → {OUTPUT_FILE}")
     print("   Open it in any web browser to view the grid.")
@@ -14,18 +14,37 @@ Run:
   python visualize_trajectories.py
 
 Requirements:
-  pip install folium pandas requests python-dotenv
+  pip install folium pandas numpy requests python-dotenv
+  pip install orjson           # optional — faster route-cache load/save
+  pip install numba            # optional — compiled segment counting
 """
 
 import os
 import json
 import time
+import threading
+import numpy as np
 import pandas as pd
 import requests
 import folium
 from collections import defaultdict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:                  # optional — stdlib json is used
+    HAVE_ORJSON = False
+
+try:
+    from numba import njit, types
+    from numba.typed import Dict
+    HAVE_NUMBA = True
+except ImportError:                  # optional — pure-Python counting is used
+    HAVE_NUMBA = False
+
 # ─── Load API Key ──────────────────────────────────────────────────────────────
 load_dotenv()
 ORS_API_KEY = os.getenv("ORS_API_KEY")
@@ -33,6 +52,7 @@ ORS_API_KEY = os.getenv("ORS_API_KEY")
 # ─── File Paths ────────────────────────────────────────────────────────────────
 CSV_FILE    = "synthetic_ride_hail_phnom_penh.csv"
 CACHE_FILE  = "route_cache.json"
+CACHE_LOG   = "route_cache.log"     # new routes since the last full snapshot
 OUTPUT_FILE = "trajectory_map.html"
 
 # ─── ORS Rate Limit Settings ───────────────────────────────────────────────────
@@ -41,11 +61,36 @@ OUTPUT_FILE = "trajectory_map.html"
 BATCH_SIZE  = 35
 BATCH_DELAY = 65    # seconds between batches
 
+# Requests within a batch are sent concurrently over one keep-alive session.
+# Each batch still waits BATCH_DELAY afterwards, so the per-minute total is
+# unchanged — only the round-trips overlap.
+FETCH_WORKERS = 10
+SESSION       = requests.Session()
+_cache_lock   = threading.Lock()   # guards cache writes from worker threads
+
+# New routes are appended to CACHE_LOG after every batch; the full
+# CACHE_FILE snapshot is only rewritten (and the log cleared) this often.
+COMPACT_EVERY = 20   # batches
+
 # ─── Segment Deduplication ─────────────────────────────────────────────────────
 # Coordinates rounded to this many decimal places to detect shared road segments
 # (4 decimal places ≈ ~11 metres precision — good for road-level matching)
 COORD_ROUND = 4
 
+# Rounded points are packed into a single int: lat/lon are scaled to integers,
+# shifted to be non-negative, and laid out as [lat bits | lon bits]. A segment
+# key is [lower point | higher point], so integer order == (lat, lon) order.
+_COORD_SCALE = 10 ** COORD_ROUND
+_LAT_OFFSET  = 90 * _COORD_SCALE
+_LON_OFFSET  = 180 * _COORD_SCALE
+_LON_BITS    = (2 * _LON_OFFSET).bit_length()
+_POINT_BITS  = (2 * _LAT_OFFSET).bit_length() + _LON_BITS
+
+# count_segments switches to the Numba kernel (when numba is installed) from
+# this many routes. Loading the kernel costs ~0.2 s per run even from Numba's
+# disk cache, so below a few thousand routes the plain loop is as fast.
+NUMBA_MIN_ROUTES = 5_000
+
 # ─── Visual Style Ranges ───────────────────────────────────────────────────────
 MIN_WEIGHT  = 2     # line width at lowest frequency
 MAX_WEIGHT  = 9     # line width at highest frequency
@@ -67,17 +112,56 @@ VEHICLE_CONFIG = {
 # ─────────────────────────────────────────────────────────────────────────────
 
 def load_cache() -> dict:
-    """Load existing route cache from disk, or return empty dict."""
+    """
+    Load the route cache from disk, or return empty dict.
+    Entries in CACHE_LOG (not yet compacted into CACHE_FILE) are replayed
+    on top of the snapshot.
+    """
+    cache = {}
     if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as f:
-            return json.load(f)
-    return {}
+        if HAVE_ORJSON:
+            with open(CACHE_FILE, "rb") as f:
+                cache = orjson.loads(f.read())
+        else:
+            with open(CACHE_FILE, "r") as f:
+                cache = json.load(f)
+
+    if os.path.exists(CACHE_LOG):
+        loads = orjson.loads if HAVE_ORJSON else json.loads
+        with open(CACHE_LOG, "rb") as f:
+            for line in f:
+                try:
+                    key, route = loads(line)
+                except ValueError:
+                    continue   # torn line from an interrupted run
+                cache[key] = route
+    return cache
 
 
 def save_cache(cache: dict):
-    """Persist route cache to disk."""
-    with open(CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+    """Write a full snapshot of the route cache to disk and clear the log."""
+    if HAVE_ORJSON:
+        with open(CACHE_FILE, "wb") as f:
+            f.write(orjson.dumps(cache))
+    else:
+        with open(CACHE_FILE, "w") as f:
+            json.dump(cache, f)
+
+    if os.path.exists(CACHE_LOG):
+        os.remove(CACHE_LOG)
+
+
+def append_cache_log(entries):
+    """Append (key, route) pairs to CACHE_LOG, one JSON array per line."""
+    dumps = orjson.dumps if HAVE_ORJSON else (lambda o: json.dumps(o).encode())
+    with open(CACHE_LOG, "a+b") as f:
+        # Terminate a torn last line so it can't swallow the next entry
+        if f.seek(0, os.SEEK_END):
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        for key, route in entries:
+            f.write(dumps([key, route]) + b"\n")
 
 
 def make_cache_key(origin: tuple, dest: tuple, profile: str) -> str:
@@ -102,7 +186,8 @@ def fetch_route(origin: tuple, dest: tuple, profile: str, cache: dict):
     Fetch a route polyline from ORS for the given origin, destination, profile.
 
     Returns a list of [lat, lon] coordinate pairs, or None on failure.
-    Results are cached in `cache` (passed by reference).
+    Results are cached in `cache` (passed by reference). Safe to call from
+    several threads at once.
 
     ORS expects [longitude, latitude] order; we convert to [lat, lon] on return.
     """
@@ -124,12 +209,13 @@ def fetch_route(origin: tuple, dest: tuple, profile: str, cache: dict):
     }
 
     try:
-        resp = requests.post(url, json=body, headers=headers, timeout=15)
+        resp = SESSION.post(url, json=body, headers=headers, timeout=15)
 
         if resp.status_code == 200:
             raw_coords = resp.json()["features"][0]["geometry"]["coordinates"]
             latlon = [[c[1], c[0]] for c in raw_coords]   # → [lat, lon]
-            cache[key] = latlon
+            with _cache_lock:
+                cache[key] = latlon
             return latlon
 
         elif resp.status_code == 429:
@@ -154,9 +240,105 @@ def fetch_route(origin: tuple, dest: tuple, profile: str, cache: dict):
 # Segment Frequency Counting
 # ─────────────────────────────────────────────────────────────────────────────
 
-def round_point(pt) -> tuple:
-    """Round a [lat, lon] point to COORD_ROUND decimals for segment matching."""
-    return (round(pt[0], COORD_ROUND), round(pt[1], COORD_ROUND))
+def point_codes(coords: np.ndarray) -> np.ndarray:
+    """
+    Pack an (N, 2) array of [lat, lon] points into int64 codes (see
+    _POINT_BITS), rounding each coordinate exactly as round(x, COORD_ROUND).
+
+    Scaling first and then rounding agrees with round() except where the
+    float product lands exactly on .5 while the true value sits just above
+    or below it — common, since ORS returns 5-decimal coordinates. Those
+    ties are settled with round() itself.
+    """
+    scaled = coords * _COORD_SCALE
+    pts    = np.rint(scaled).astype(np.int64)
+
+    ties = np.flatnonzero(scaled - np.floor(scaled) == 0.5)
+    if len(ties):
+        flat = pts.reshape(-1)
+        for i, value in zip(ties.tolist(), coords.reshape(-1)[ties].tolist()):
+            flat[i] = round(round(value, COORD_ROUND) * _COORD_SCALE)
+
+    return ((pts[:, 0] + _LAT_OFFSET) << _LON_BITS) | (pts[:, 1] + _LON_OFFSET)
+
+
+def segment_keys(route) -> list[int]:
+    """
+    Return the canonical int key of every consecutive-point segment of a
+    route (see _POINT_BITS). Rounding and packing are vectorised per route.
+    """
+    codes = point_codes(np.asarray(route, dtype=float))
+    lo = np.minimum(codes[:-1], codes[1:]).tolist()
+    hi = np.maximum(codes[:-1], codes[1:]).tolist()
+    return [(a << _POINT_BITS) | b for a, b in zip(lo, hi)]
+
+
+def unpack_segment(seg: int) -> list[list[float]]:
+    """Turn a segment key back into [[lat, lon], [lat, lon]]."""
+    lon_mask = (1 << _LON_BITS) - 1
+    points = []
+    for code in (seg >> _POINT_BITS, seg & ((1 << _POINT_BITS) - 1)):
+        points.append([
+            ((code >> _LON_BITS) - _LAT_OFFSET) / _COORD_SCALE,
+            ((code & lon_mask) - _LON_OFFSET) / _COORD_SCALE,
+        ])
+    return points
+
+
+def _routes_to_soa(routes: list) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pack route polylines into one contiguous (N, 2) [lat, lon] buffer plus
+    int32 offsets: route i is coords[offsets[i] : offsets[i + 1]].
+
+    Kept at float64 so point_codes rounds exactly as segment_keys does.
+    """
+    offsets = np.zeros(len(routes) + 1, dtype=np.int32)
+    np.cumsum([len(route) for route in routes], out=offsets[1:])
+
+    coords = np.empty((offsets[-1], 2), dtype=np.float64)
+    bounds = offsets.tolist()
+    for i, route in enumerate(routes):
+        coords[bounds[i]:bounds[i + 1]] = route
+
+    return coords, offsets
+
+
+if HAVE_NUMBA:
+    _SEG_TYPE = types.UniTuple(types.int64, 2)   # (lower code, higher code)
+
+    @njit(cache=True)
+    def _count_segments_soa(codes, offsets):
+        """
+        Compiled core of count_segments over the point_codes of a
+        _routes_to_soa buffer. Segments are keyed by their (lower, higher)
+        point codes. Returns parallel arrays (lo_codes, hi_codes, counts),
+        in first-seen order.
+        """
+        seg_count  = Dict.empty(key_type=_SEG_TYPE, value_type=types.int64)
+        last_route = Dict.empty(key_type=_SEG_TYPE, value_type=types.int64)
+
+        for r in range(offsets.shape[0] - 1):
+            start, end = offsets[r], offsets[r + 1]
+            prev = 0
+            for i in range(start, end):
+                code = codes[i]
+                if i > start:
+                    seg = (min(prev, code), max(prev, code))
+                    # last_route stands in for a per-route "seen" set
+                    if last_route.get(seg, -1) != r:
+                        last_route[seg] = r
+                        seg_count[seg] = seg_count.get(seg, 0) + 1
+                prev = code
+
+        n = len(seg_count)
+        lo_codes = np.empty(n, dtype=np.int64)
+        hi_codes = np.empty(n, dtype=np.int64)
+        counts   = np.empty(n, dtype=np.int64)
+        j = 0
+        for seg, cnt in seg_count.items():
+            lo_codes[j], hi_codes[j], counts[j] = seg[0], seg[1], cnt
+            j += 1
+        return lo_codes, hi_codes, counts
 
 
 def count_segments(routes: list) -> dict:
@@ -169,16 +351,29 @@ def count_segments(routes: list) -> dict:
     Each route contributes at most 1 count per unique segment
     (prevents a single long route from inflating a segment's count).
 
-    Returns: {segment_tuple → int frequency}
+    Uses the Numba kernel for NUMBA_MIN_ROUTES or more routes when numba is
+    installed.
+
+    Returns: {segment_key → int frequency}, in first-seen order
     """
+    routes = [route for route in routes if route]
+
+    if HAVE_NUMBA and len(routes) >= NUMBA_MIN_ROUTES:
+        coords, offsets = _routes_to_soa(routes)
+        lo_codes, hi_codes, counts = _count_segments_soa(
+            point_codes(coords), offsets
+        )
+        return {
+            (lo << _POINT_BITS) | hi: cnt
+            for lo, hi, cnt in zip(lo_codes.tolist(), hi_codes.tolist(),
+                                   counts.tolist())
+        }
+
     seg_count = defaultdict(int)
 
     for route in routes:
-        if not route:
-            continue
         seen_in_this_route = set()
-        for i in range(len(route) - 1):
-            seg = tuple(sorted([round_point(route[i]), round_point(route[i + 1])]))
+        for seg in segment_keys(route):
             if seg not in seen_in_this_route:
                 seen_in_this_route.add(seg)
                 seg_count[seg] += 1
@@ -219,46 +414,74 @@ def main():
     cache_hits_start = len(cache)
 
     # ── Collect trips per vehicle ─────────────────────────────────────────────
-    all_trips = []   # list of (vehicle_type, origin, dest, profile)
+    # Many trips share the same (origin, dest, profile) cache key, so routes
+    # are fetched once per unique key and fanned back out to trips afterwards.
+    all_trips    = []   # list of (vehicle_type, cache_key)
+    unique_trips = {}   # {cache_key → (origin, dest, profile)}
 
     for _, row in df.iterrows():
         vtype = row["vehicle_type"]
         if vtype not in VEHICLE_CONFIG:
             continue
-        all_trips.append((
-            vtype,
-            (row["dept_lat"], row["dept_lon"]),
-            (row["arr_lat"],  row["arr_lon"]),
-            VEHICLE_CONFIG[vtype]["profile"],
-        ))
-
-    total       = len(all_trips)
+        origin  = (row["dept_lat"], row["dept_lon"])
+        dest    = (row["arr_lat"],  row["arr_lon"])
+        profile = VEHICLE_CONFIG[vtype]["profile"]
+
+        key = make_cache_key(origin, dest, profile)
+        unique_trips.setdefault(key, (origin, dest, profile))
+        all_trips.append((vtype, key))
+
+    # Cache hits are resolved up front so every batch slot (and every
+    # BATCH_DELAY pause) is spent on a real ORS request. ORS quotas count
+    # requests, but a multi-waypoint request returns one route through all
+    # the points rather than one route per trip, so trips are still sent one
+    # per request — over the shared keep-alive SESSION.
+    routes_by_key = {   # {cache_key → route_polyline or None}
+        key: cache[key] for key in unique_trips if key in cache
+    }
+    pending     = [(key, trip) for key, trip in unique_trips.items()
+                   if key not in routes_by_key]
+    total       = len(pending)
     num_batches = (total + BATCH_SIZE - 1) // BATCH_SIZE
-    est_minutes = round((num_batches * BATCH_DELAY) / 60, 1)
+    est_minutes = round((max(num_batches - 1, 0) * BATCH_DELAY) / 60, 1)
 
-    print(f"\nFetching routes for {total} trips")
+    print(f"\nFetching routes for {len(all_trips)} trips "
+          f"({len(unique_trips)} unique routes, {len(routes_by_key)} already cached)")
     print(f"  Batch size : {BATCH_SIZE}  |  Delay between batches: {BATCH_DELAY}s")
-    print(f"  Estimated time (worst case, no cache): ~{est_minutes} min\n")
+    print(f"  Estimated time for {total} uncached routes: ~{est_minutes} min\n")
 
     # ── Fetch routes in batches ───────────────────────────────────────────────
-    vehicle_routes = defaultdict(list)   # {vehicle_type → [route_polyline, ...]}
 
-    for batch_idx in range(0, total, BATCH_SIZE):
-        batch = all_trips[batch_idx: batch_idx + BATCH_SIZE]
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for batch_idx in range(0, total, BATCH_SIZE):
+            batch = pending[batch_idx: batch_idx + BATCH_SIZE]
+            size_before = len(cache)
+
+            results = executor.map(
+                lambda item: fetch_route(*item[1], cache), batch
+            )
+            for (key, _), coords in zip(batch, results):
+                routes_by_key[key] = coords
+
+            # Persist after every batch: append just the new routes (dicts keep
+            # insertion order), and fold the log into a snapshot now and then.
+            append_cache_log(islice(cache.items(), size_before, None))
+            if (batch_idx // BATCH_SIZE + 1) % COMPACT_EVERY == 0:
+                save_cache(cache)
 
-        for vtype, origin, dest, profile in batch:
-            coords = fetch_route(origin, dest, profile, cache)
-            vehicle_routes[vtype].append(coords)
+            done = min(batch_idx + BATCH_SIZE, total)
+            new_hits = len(cache) - cache_hits_start
+            print(f"  [{done:>4}/{total}]  cache size: {len(cache)}  (+{new_hits} new routes fetched)")
 
-        save_cache(cache)   # persist after every batch
+            if done < total:
+                print(f"  Waiting {BATCH_DELAY}s...")
+                time.sleep(BATCH_DELAY)
 
-        done = min(batch_idx + BATCH_SIZE, total)
-        new_hits = len(cache) - cache_hits_start
-        print(f"  [{done:>4}/{total}]  cache size: {len(cache)}  (+{new_hits} new routes fetched)")
+    save_cache(cache)   # final compaction
 
-        if done < total:
-            print(f"  Waiting {BATCH_DELAY}s...")
-            time.sleep(BATCH_DELAY)
+    vehicle_routes = defaultdict(list)   # {vehicle_type → [route_polyline, ...]}
+    for vtype, key in all_trips:
+        vehicle_routes[vtype].append(routes_by_key[key])
 
     # ── Build Folium map ──────────────────────────────────────────────────────
     print("\nBuilding map...")
@@ -287,38 +510,42 @@ def main():
         min_c = min(seg_count.values())
         max_c = max(seg_count.values())
 
-        # Pre-compute style for every unique segment
-        seg_style = {
-            seg: (
-                normalize(cnt, min_c, max_c, MIN_OPACITY, MAX_OPACITY),  # opacity
-                normalize(cnt, min_c, max_c, MIN_WEIGHT,  MAX_WEIGHT),   # width
-                cnt,                                                       # raw count
-            )
-            for seg, cnt in seg_count.items()
-        }
+        # One LineString feature per unique segment, in first-seen order.
+        # The whole layer is a single GeoJson object instead of one PolyLine
+        # per segment. GeoJSON coordinates are [lon, lat].
+        features = []
+        for seg, cnt in seg_count.items():
+            (lat1, lon1), (lat2, lon2) = unpack_segment(seg)
+            features.append({
+                "type": "Feature",
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": [[lon1, lat1], [lon2, lat2]],
+                },
+                "properties": {
+                    "opacity": normalize(cnt, min_c, max_c, MIN_OPACITY, MAX_OPACITY),
+                    "weight":  normalize(cnt, min_c, max_c, MIN_WEIGHT,  MAX_WEIGHT),
+                    "count":   cnt,
+                },
+            })
 
         layer = folium.FeatureGroup(name=f"{icon} {vtype}", show=True)
 
-        drawn = set()   # draw each unique segment only once
-        for route in valid:
-            for i in range(len(route) - 1):
-                seg = tuple(sorted([round_point(route[i]), round_point(route[i + 1])]))
-                if seg in drawn:
-                    continue
-                drawn.add(seg)
-
-                opacity, weight, cnt = seg_style[seg]
-
-                folium.PolyLine(
-                    locations=[list(seg[0]), list(seg[1])],
-                    color=color,
-                    weight=weight,
-                    opacity=opacity,
-                    tooltip=f"{vtype} — segment used by {cnt} trip(s)",
-                ).add_to(layer)
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            style_function=lambda feature, color=color: {
+                "color":   color,
+                "weight":  feature["properties"]["weight"],
+                "opacity": feature["properties"]["opacity"],
+            },
+            tooltip=folium.GeoJsonTooltip(
+                fields=["count"],
+                aliases=[f"{vtype} — trips using this segment"],
+            ),
+        ).add_to(layer)
 
         layer.add_to(m)
-        print(f"  ✓ {icon} {vtype:10s}  routes: {len(valid):4d}  unique segments: {len(drawn):5d}  "
+        print(f"  ✓ {icon} {vtype:10s}  routes: {len(valid):4d}  unique segments: {len(features):5d}  "
               f"freq range: {min_c}–{max_c}")
 
     # ── Layer control + legend ────────────────────────────────────────────────